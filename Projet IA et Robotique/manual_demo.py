@@ -24,6 +24,7 @@ except RuntimeError:
 
 MODEL_NAME = "phi3:mini"
 console = Console()
+_WRAPPER = textwrap.TextWrapper(width=90, break_long_words=False)
 
 
 def call_local_llm(prompt: str) -> str:
@@ -78,18 +79,17 @@ class RegexBanList(Validator):
         self.banned_words = ["kitty", "meow"]
         patterns = [r"\bcat[s]?\b", r"\bkitten[s]?\b"]
 
-        self.compiled_patterns = [re.compile(p, re.IGNORECASE) for p in patterns]
+        # One case-insensitive alternation instead of lowercasing the whole
+        # text and looping over words and patterns separately.
+        alternatives = [re.escape(word) for word in self.banned_words] + patterns
+        self.banned_pattern = re.compile(
+            "|".join(f"(?:{a})" for a in alternatives), re.IGNORECASE
+        )
 
     def _validate(self, value, metadata):
-        text_lower = value.lower()
-
-        for word in self.banned_words:
-            if word.lower() in text_lower:
-                return FailResult(f"Text contains banned word: '{word}'")
-
-        for pattern in self.compiled_patterns:
-            if pattern.search(value):
-                return FailResult("Text matched banned regex pattern.")
+        match = self.banned_pattern.search(value)
+        if match:
+            return FailResult(f"Text contains banned term: '{match.group(0)}'")
 
         return PassResult()
 
@@ -181,7 +181,7 @@ def pretty_print_turn(
 
     panels_list.append(
         Panel(
-            textwrap.fill(original_prompt or "", width=90),
+            _WRAPPER.fill(original_prompt or ""),
             title="Input Prompt",
             title_align="left",
             border_style="cyan",
@@ -192,7 +192,7 @@ def pretty_print_turn(
         prompt_filtered = (prompt_after_guard or "") != (original_prompt or "")
         panels_list.append(
             Panel(
-                textwrap.fill(prompt_after_guard or "", width=90),
+                _WRAPPER.fill(prompt_after_guard or ""),
                 title="Input Prompt (After Guard)",
                 title_align="left",
                 border_style="red" if prompt_filtered else "green",
@@ -201,7 +201,7 @@ def pretty_print_turn(
 
     panels_list.append(
         Panel(
-            textwrap.fill(baseline_output or "", width=90),
+            _WRAPPER.fill(baseline_output or ""),
             title="LLM Output (Baseline)",
             title_align="left",
             border_style="yellow",
@@ -213,7 +213,7 @@ def pretty_print_turn(
         response_filtered = (output_after_guard or "") != (baseline_output or "")
         panels_list.append(
             Panel(
-                textwrap.fill(output_after_guard or "Sorry, I can't help with that.", width=90),
+                _WRAPPER.fill(output_after_guard or "Sorry, I can't help with that."),
                 title="Output (After Guard)",
                 title_align="left",
                 border_style="red" if response_filtered else "green",